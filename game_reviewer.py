@@ -1,68 +1,508 @@
 import asyncio
 import os
-from functools import lru_cache
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
 import chess
 import chess.engine
 import chess.pgn
 import dotenv
+import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Field, SQLModel, Session, col, select
 
-from utils import sanitize_povscore
+from utils import encode_position, sanitize_povscore
 
 dotenv.load_dotenv()
 
 ENGINE = os.getenv("STOCKFISH")
+# Search each position to a fixed node count rather than for a fixed time,
+# so that evaluations are reproducible and do not depend on machine load.
+REVIEW_NODES = int(os.getenv("REVIEW_NODES", 200_000))
+# Number of engine processes to keep running, and the size (in MB) of each
+# one's hash table. Stockfish allocates its hash as soon as the option is
+# set, so ENGINE_POOL_SIZE * ENGINE_HASH_MB is reserved at startup: 4 GB
+# with the defaults on a 16-core host. Lower either on a small machine.
+ENGINE_POOL_SIZE = int(os.getenv("ENGINE_POOL_SIZE", os.cpu_count() or 1))
+ENGINE_HASH_MB = int(os.getenv("ENGINE_HASH_MB", 256))
+# Halfmove clock from which the fifty-move rule may affect the engine's
+# score, so that the position's evaluation is not cached
+HISTORY_HALFMOVES = 60
 default_fen = chess.STARTING_FEN
 
 
-class GameReviewer:
-    async def create_review(self, game: chess.pgn.Game) -> chess.pgn.Game:
+# The NAG for a move, indexed by the pawns it loses (deficit // 100, capped
+# at 5)
+NAG_TABLE = [
+    0,
+    chess.pgn.NAG_DUBIOUS_MOVE,  # loses a pawn
+    chess.pgn.NAG_DUBIOUS_MOVE,
+    chess.pgn.NAG_MISTAKE,  # loses a minor piece
+    chess.pgn.NAG_MISTAKE,
+    chess.pgn.NAG_BLUNDER,  # loses a major piece
+]
+
+# Main lines of common openings. Every position along these is sound, so
+# reviews give them a nominal evaluation instead of searching them.
+BOOK_LINES = [
+    "e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7",  # Ruy Lopez
+    "e4 e5 Nf3 Nc6 Bc4 Bc5 c3 Nf6 d3 d6",  # Giuoco Piano
+    "e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6",  # Sicilian Najdorf
+    "e4 e6 d4 d5 Nc3 Nf6",  # French
+    "e4 c6 d4 d5 Nc3 dxe4 Nxe4 Bf5",  # Caro-Kann
+    "d4 d5 c4 e6 Nc3 Nf6 Bg5 Be7",  # Queen's Gambit Declined
+    "d4 d5 c4 c6 Nf3 Nf6",  # Slav
+    "d4 Nf6 c4 e6 Nc3 Bb4",  # Nimzo-Indian
+    "d4 Nf6 c4 g6 Nc3 Bg7 e4 d6 Nf3 O-O",  # King's Indian
+    "c4 e5 Nc3 Nf6",  # English
+    "Nf3 d5 g3 Nf6",  # Reti
+]
+
+
+def _book(lines: list[str]) -> dict[bytes, chess.engine.PovScore]:
+    book = {}
+    for line in lines:
+        board = chess.Board()
+        book[encode_position(board)] = chess.engine.PovScore(
+            chess.engine.Cp(20), chess.WHITE
+        )
+        for san in line.split():
+            board.push_san(san)
+            book[encode_position(board)] = chess.engine.PovScore(
+                chess.engine.Cp(20), chess.WHITE
+            )
+    return book
+
+
+BOOK = _book(BOOK_LINES)
+
+
+def _history_dependent(board: chess.Board) -> bool:
+    # encode_position leaves out the moves leading up to a position, but
+    # the engine's score of it depends on them if the position has already
+    # occurred (a repetition may be in reach) or if the fifty-move rule is
+    # within its search horizon. Such a score can't be shared with the same
+    # position reached another way.
+    return board.is_repetition(2) or board.halfmove_clock >= HISTORY_HALFMOVES
+
+
+def _quick_score(board: chess.Board, key: bytes | None) -> chess.engine.PovScore | None:
+    """The score of a position that does not need searching, if it is one."""
+    outcome = board.outcome()
+    if outcome is not None:
+        if outcome.winner is None:
+            return chess.engine.PovScore(chess.engine.Cp(0), board.turn)
+        # The side to move has been mated
+        return chess.engine.PovScore(chess.engine.Mate(0), board.turn)
+    if key is None:
+        return None
+    return BOOK.get(key)
+
+
+def _snapshot(board: chess.Board) -> chess.Board:
+    # Copying the whole move stack makes each copy O(depth), and a line of
+    # copies O(depth^2). Only moves since the last capture or pawn move can
+    # be repeated, so those are all the engine needs to be sent.
+    return board.copy(stack=board.halfmove_clock)
+
+
+def _first_error(group: BaseExceptionGroup) -> BaseException:
+    exc: BaseException = group
+    while isinstance(exc, BaseExceptionGroup):
+        exc = exc.exceptions[0]
+    return exc
+
+
+class EnginePool:
+    """A fixed number of warm engine processes, shared between reviews."""
+
+    def __init__(self, size: int, hash_mb: int = ENGINE_HASH_MB) -> None:
+        self.size = size
+        self.options = {
+            # Split the machine's cores between the engines in the pool
+            "Threads": max(1, (os.cpu_count() or 1) // size),
+            # A large transposition table lets the engine reuse its work
+            # on earlier plies of the same game
+            "Hash": hash_mb,
+            "UCI_AnalyseMode": True,
+        }
+        # Engines that are running, whether idle or in use
+        self.live = 0
+        self.closing = False
+        # Replacements for dead engines that are still starting up
+        self.respawning: set[asyncio.Task[None]] = set()
+        # LIFO, so that the engine that was just returned (and whose hash
+        # is warm with the positions of the current game) is the next one
+        # handed out. None is put in when the last engine dies, to wake up
+        # anyone waiting for one.
+        self.queue: asyncio.LifoQueue[chess.engine.UciProtocol | None] = (
+            asyncio.LifoQueue()
+        )
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _respawn(self, engine: chess.engine.UciProtocol) -> None:
+        # Replace a dead engine, so that the pool does not shrink. The
+        # replacement is started in the background, so that it is not
+        # abandoned if the review that found the dead engine is cancelled
+        # meanwhile.
+        engine.transport.close()
+        self.live -= 1
+        if self.live == 0:
+            self.queue.put_nowait(None)
+        if self.closing:
+            return
+        respawn = asyncio.create_task(self._respawn_loop())
+        self.respawning.add(respawn)
+        respawn.add_done_callback(self.respawning.discard)
+
+    async def _respawn_loop(self) -> None:
+        # Keep trying, backing off, until an engine starts; the pool only
+        # ever shrinks for as long as that takes.
+        delay = 1
+        while True:
+            try:
+                engine = await self._spawn()
+            except Exception:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+            else:
+                self.live += 1
+                self.queue.put_nowait(engine)
+                return
+
+    async def _spawn(self) -> chess.engine.UciProtocol:
         transport, engine = await chess.engine.popen_uci(ENGINE)
+        await engine.configure(self.options)
+        return engine
+
+    async def start(self) -> None:
+        for _ in range(self.size):
+            self.queue.put_nowait(await self._spawn())
+            self.live += 1
+
+    async def _get(self) -> chess.engine.UciProtocol:
+        while True:
+            if self.live == 0:
+                raise chess.engine.EngineTerminatedError("no engine is running")
+            engine = await self.queue.get()
+            if engine is None:
+                # Every engine died while we waited. Pass the wake-up on to
+                # the next waiter, unless one has been respawned since.
+                if self.live == 0:
+                    self.queue.put_nowait(None)
+                continue
+            # An engine can also die while it sits idle in the pool, e.g.
+            # just after a cancelled search.
+            if engine.transport.get_returncode() is not None:
+                self._respawn(engine)
+                continue
+            return engine
+
+    async def close(self) -> None:
+        self.closing = True
+        for respawn in self.respawning:
+            respawn.cancel()
+        await asyncio.gather(*self.respawning, return_exceptions=True)
+        closed = 0
+        while closed < self.live:
+            engine = await self.queue.get()
+            if engine is None:
+                continue
+            if engine.transport.get_returncode() is None:
+                await engine.quit()
+            else:
+                engine.transport.close()
+            closed += 1
 
-        @lru_cache(maxsize=1024)
-        async def _eval_fen(fen: str) -> chess.engine.PovScore:
-            board = chess.Board(fen)
-            info = await engine.analyse(board, chess.engine.Limit(time=0.1))
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[chess.engine.UciProtocol]:
+        """
+        Borrow an idle engine, waiting for one if need be. Raises
+        EngineTerminatedError if no engine is running at all.
+        """
+        engine = await self._get()
+        try:
+            yield engine
+        except chess.engine.EngineTerminatedError:
+            # The process died under us
+            self._respawn(engine)
+            raise
+        except BaseException:
+            self.queue.put_nowait(engine)
+            raise
+        else:
+            self.queue.put_nowait(engine)
+
+
+class PosEval(SQLModel, table=True):
+    """An engine evaluation of a position, keyed by encode_position."""
+
+    key: bytes = Field(primary_key=True)
+    # Relative to the side to move, as reported by the engine
+    score_cp: int | None
+    mate: int | None
+    nodes: int
+
+
+class GameReviewer:
+    def __init__(self, pool: EnginePool, db: sqlalchemy.Engine | None = None) -> None:
+        self.pool = pool
+        self.db = db
+
+    def _load_scores(self, pos_keys: list[bytes]) -> dict[bytes, chess.engine.Score]:
+        """
+        The stored scores for those of pos_keys that have one, relative to
+        the side to move.
+        """
+        if self.db is None or not pos_keys:
+            return {}
+        query = select(PosEval).where(
+            col(PosEval.key).in_(pos_keys), PosEval.nodes >= REVIEW_NODES
+        )
+        with Session(self.db) as session:
+            rows = session.exec(query).all()
+        return {
+            row.key: (
+                chess.engine.Mate(row.mate)
+                if row.mate is not None
+                else chess.engine.Cp(row.score_cp)
+            )
+            for row in rows
+        }
+
+    def _store_scores(self, scores: dict[bytes, chess.engine.PovScore]) -> None:
+        if self.db is None or not scores:
+            return
+        rows = [
+            dict(
+                key=pos_key,
+                score_cp=score.relative.score(),
+                mate=score.relative.mate(),
+                nodes=REVIEW_NODES,
+            )
+            for pos_key, score in scores.items()
+        ]
+
+        if self.db.dialect.name not in ("postgresql", "sqlite"):
+            with Session(self.db) as session:
+                for row in rows:
+                    session.merge(PosEval(**row))
+                session.commit()
+            return
+
+        if self.db.dialect.name == "postgresql":
+            insert = postgresql.insert
+        else:
+            insert = sqlite.insert
+        stmt = insert(PosEval).values(rows)
+        # Keep whichever evaluation searched deeper; another review may
+        # have stored this position first.
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[PosEval.key],
+            set_={
+                "score_cp": stmt.excluded.score_cp,
+                "mate": stmt.excluded.mate,
+                "nodes": stmt.excluded.nodes,
+            },
+            where=col(PosEval.nodes) < stmt.excluded.nodes,
+        )
+        with self.db.begin() as conn:
+            conn.execute(stmt)
+
+    async def create_review(
+        self, game: chess.pgn.Game, key: str | None = None
+    ) -> chess.pgn.Game:
+        # python-chess sends ucinewgame, clearing the engine's hash, only
+        # when an engine is handed a position from a different game than
+        # its last one. Identify games by key where there is one, so that
+        # reviewing the same game again can still use the hash.
+        game_id = key if key is not None else game
+
+        # Repeated positions (transpositions, shared variations) are only
+        # analysed once; concurrent requests for the same position wait on
+        # the same future.
+        cache: dict[bytes, asyncio.Future[chess.engine.PovScore]] = {}
+        loop = asyncio.get_running_loop()
+
+        # Heavily annotated games can have hundreds of variations; only
+        # keep as many positions in flight as there are engines to analyse
+        # them.
+        sem = asyncio.Semaphore(len(self.pool))
+
+        async def _analyse(board: chess.Board) -> chess.engine.PovScore:
+            # Pass the board itself rather than its FEN, so that the engine
+            # is sent the moves leading up to the position ("position ...
+            # moves ...") and knows about repetitions.
+            # An engine can only run one search at a time; a second command
+            # sent to a busy engine cancels the first.
+            # Only the score is used, so don't have python-chess parse the
+            # PV and other fields of every info line.
+            async with self.pool.acquire() as engine:
+                info = await engine.analyse(
+                    board,
+                    chess.engine.Limit(nodes=REVIEW_NODES),
+                    info=chess.engine.INFO_SCORE,
+                    game=game_id,
+                )
             return info["score"]
 
-        async def _eval_inner(
-            node: chess.pgn.GameNode, prevscore: chess.engine.PovScore | None
+        async def _eval_board(
+            board: chess.Board,
+            pos_key: bytes | None,
+            fresh: dict[bytes, chess.engine.PovScore],
+        ) -> chess.engine.PovScore:
+            # Positions whose score depends on their history have no key,
+            # and are neither shared nor stored.
+            if pos_key is None:
+                return await _analyse(board)
+            if pos_key in cache:
+                # Shield the future: if this waiter is cancelled, the
+                # analysis it is waiting on carries on for its owner.
+                return await asyncio.shield(cache[pos_key])
+
+            fut = cache[pos_key] = loop.create_future()
+            try:
+                score = await _analyse(board)
+            except BaseException as exc:
+                del cache[pos_key]
+                if isinstance(exc, Exception):
+                    # Anyone waiting on this position gets the real error.
+                    # Retrieve it once so that asyncio does not warn about
+                    # it; it is raised to our own caller below.
+                    fut.set_exception(exc)
+                    fut.exception()
+                else:
+                    fut.cancel()
+                raise
+            fut.set_result(score)
+            fresh[pos_key] = score
+            return score
+
+        def _annotate(
+            nodes: list[chess.pgn.GameNode],
+            boards: list[chess.Board],
+            prevscore: chess.engine.PovScore | None,
+            scores: list[chess.engine.PovScore],
+        ) -> None:
+            # Put the whole line's scores on one scale (White's point of
+            # view, with checkmate worth 20 pawns) in a single pass, then
+            # compare each ply with the one before it.
+            nums = [score.white().score(mate_score=20_00) for score in scores]
+            prev_nums = [
+                None if prevscore is None else prevscore.white().score(mate_score=20_00)
+            ] + nums[:-1]
+
+            for node, board, score, prev_num, cur_num in zip(
+                nodes, boards, scores, prev_nums, nums
+            ):
+                if prev_num is not None:
+                    # board.turn is the turn of the player about to take the
+                    # next move, so the move that has just happened was made
+                    # by the other side. A bad move will have a positive
+                    # deficit.
+                    if board.turn == chess.BLACK:
+                        deficit = prev_num - cur_num
+                    else:
+                        deficit = cur_num - prev_num
+
+                    nag = NAG_TABLE[min(max(deficit // 100, 0), 5)]
+                    if nag:
+                        node.nags.add(nag)
+
+                if node.nags:
+                    node.comment = sanitize_povscore(score.white())
+
+        async def _eval_bounded(
+            board: chess.Board,
+            pos_key: bytes | None,
+            fresh: dict[bytes, chess.engine.PovScore],
+        ) -> chess.engine.PovScore:
+            async with sem:
+                return await _eval_board(board, pos_key, fresh)
+
+        async def _eval_line(
+            node: chess.pgn.GameNode,
+            board: chess.Board,
+            prevscore: chess.engine.PovScore | None,
         ) -> None:
-            # Evaluate the board at this node, which is the state AFTER
-            # a move.
+            # Walk down the main line from node, pushing each move onto
+            # board rather than rebuilding it from the root with
+            # node.board(). board is the state AFTER node's move. Keep a
+            # snapshot of the board at each ply so that the whole line can
+            # be analysed at once, spread across the engine pool.
+            nodes = [node]
+            boards = [_snapshot(board)]
+            while node.variations:
+                node = node.variations[0]
+                board.push(node.move)
+                nodes.append(node)
+                boards.append(_snapshot(board))
+
+            pos_keys = [
+                None if _history_dependent(b) else encode_position(b) for b in boards
+            ]
+            scores = [_quick_score(b, k) for b, k in zip(boards, pos_keys)]
 
-            board = node.board()
-            score = await _eval_fen(board.fen())
+            # A position with only one legal move is worth as much as the
+            # position after that move, which is the next ply; there is no
+            # need to search it.
+            todo = [
+                i
+                for i, b in enumerate(boards)
+                if scores[i] is None
+                and (i + 1 == len(boards) or b.legal_moves.count() != 1)
+            ]
 
-            if prevscore is not None:
-                # board.turn is the turn of the player about to take the
-                # next move, so we need its inverse if we want to evaluate
-                # the move that has just happened
+            # Fetch the whole line's stored evaluations in one query, off
+            # the event loop
+            stored = await asyncio.to_thread(
+                self._load_scores,
+                [
+                    key
+                    for key in (pos_keys[i] for i in todo)
+                    if key is not None and key not in cache
+                ],
+            )
 
-                # checkmate is worth 20 pawns
-                prev_num = prevscore.pov(not board.turn).score(mate_score=20_00)
-                cur_num = score.pov(not board.turn).score(mate_score=20_00)
+            # Positions this line had analysed, to be stored afterwards
+            fresh: dict[bytes, chess.engine.PovScore] = {}
 
-                # a bad move will have a positive deficit
-                deficit = prev_num - cur_num
+            # If one analysis fails, the task group cancels the rest, so
+            # that they return their engines to the pool.
+            tasks = {}
+            async with asyncio.TaskGroup() as tg:
+                for i in todo:
+                    if pos_keys[i] in stored:
+                        scores[i] = chess.engine.PovScore(
+                            stored[pos_keys[i]], boards[i].turn
+                        )
+                    else:
+                        tasks[i] = tg.create_task(
+                            _eval_bounded(boards[i], pos_keys[i], fresh)
+                        )
+            for i, task in tasks.items():
+                scores[i] = task.result()
+            for i in reversed(range(len(boards))):
+                if scores[i] is None:
+                    scores[i] = scores[i + 1]
 
-                if deficit >= 500:  # loses a major piece
-                    node.nags.add(chess.pgn.NAG_BLUNDER)
-                elif deficit >= 300:  # loses a minor piece
-                    node.nags.add(chess.pgn.NAG_MISTAKE)
-                elif deficit >= 100:  # loses a pawn
-                    node.nags.add(chess.pgn.NAG_DUBIOUS_MOVE)
+            await asyncio.to_thread(self._store_scores, fresh)
 
-            if node.nags:
-                node.comment = sanitize_povscore(score.white())
+            _annotate(nodes, boards, prevscore, scores)
 
-            coros = []
-            for var in node.variations:
-                coros.append(_eval_inner(var, score))
-            await asyncio.gather(*coros)
+            async with asyncio.TaskGroup() as tg:
+                for node, board, score in zip(nodes, boards, scores):
+                    for var in node.variations[1:]:
+                        var_board = _snapshot(board)
+                        var_board.push(var.move)
+                        tg.create_task(_eval_line(var, var_board, score))
 
         try:
-            await _eval_inner(game, prevscore=None)
-            return game
-        finally:
-            await engine.quit()
+            await _eval_line(game, game.board(), prevscore=None)
+        except BaseExceptionGroup as group:
+            # The task groups nest once per level of variations; callers
+            # want the error itself (EngineError, EngineTerminatedError...)
+            raise _first_error(group) from None
+        return game
@@ -1,5 +1,9 @@
+import asyncio
+import functools
 import hashlib
 import os
+import time
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from io import StringIO
 from pathlib import Path
@@ -15,11 +19,11 @@ from fastapi import Depends, FastAPI, Form, HTTPException
 from sqlmodel import Field, SQLModel, Session, create_engine
 from starlette import status
 from starlette.requests import Request
-from starlette.responses import RedirectResponse, Response
+from starlette.responses import FileResponse, RedirectResponse, Response
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 
-from game_reviewer import GameReviewer
+from game_reviewer import ENGINE_POOL_SIZE, EnginePool, GameReviewer
 
 dotenv.load_dotenv()
 
@@ -46,7 +50,10 @@ async def lifespan(app: FastAPI):
         StaticFiles(directory="static"),
         name="static",
     )
+    app.state.engine_pool = EnginePool(ENGINE_POOL_SIZE)
+    await app.state.engine_pool.start()
     yield
+    await app.state.engine_pool.close()
 
 
 app = fastapi.FastAPI(lifespan=lifespan)
@@ -59,34 +66,58 @@ class GameDTO(SQLModel, table=True):
     pgn: str
 
 
+_list_cache: dict[Path, tuple[int, list[str]]] = {}
+
+
 class GameManager:
     directory: Path = Path(__file__).parent / "games"
 
-    def list(self) -> list[str]:
-        return [
-            f.name
-            for f in self.directory.iterdir()
-            if f.is_file() and f.suffix == ".pgn"
-        ]
-
-    def load(self, key: str) -> chess.pgn.Game:
+    def _scan(self) -> list[str]:
+        with os.scandir(self.directory) as it:
+            return [e.name for e in it if e.is_file() and e.name.endswith(".pgn")]
+
+    async def list(self) -> list[str]:
+        # Adding or removing a file updates the directory's mtime, so only
+        # rescan when that changes.
+        # Filesystem timestamps are coarse, though: a file added in the same
+        # tick as the last scan leaves the mtime as it was. So don't trust
+        # an mtime from the last couple of seconds.
+        mtime = os.stat(self.directory).st_mtime_ns
+        settled = time.time_ns() - mtime > 2_000_000_000
+        cached = _list_cache.get(self.directory)
+        if cached is not None and cached[0] == mtime and settled:
+            return list(cached[1])
+
+        names = await asyncio.to_thread(self._scan)
+        _list_cache[self.directory] = (mtime, names)
+        return list(names)
+
+    def path(self, key: str) -> Path:
         p = self.directory / key
         if not p.exists():
             raise HTTPException(status_code=404, detail="Game not found")
         if not p.parent == self.directory:
             raise HTTPException(status_code=403, detail="Game not found")
+        return p
+
+    async def load(self, key: str) -> chess.pgn.Game:
+        p = self.path(key)
 
+        # Reading and parsing a long game takes a while; do it off the
+        # event loop so that other requests are not held up.
+        return await asyncio.to_thread(self._read, p)
+
+    def _read(self, p: Path) -> chess.pgn.Game:
         with open(p) as f:
             game = chess.pgn.read_game(f)
         return game
 
-    def save(self, key: str, game: chess.pgn.Game) -> None:
+    async def save(self, key: str, pgn: str) -> None:
         p = self.directory / key
         if not p.parent == self.directory:
             raise HTTPException(status_code=403, detail="Game not found")
 
-        with open(p, "w") as f:
-            f.write(self.as_pgn(game))
+        await asyncio.to_thread(p.write_text, pgn)
 
     def as_pgn(self, game):
         exporter = chess.pgn.StringExporter()
@@ -94,11 +125,50 @@ class GameManager:
         return output
 
 
+# Recently reviewed games, least recently viewed first. Bounded, since
+# every game submitted would otherwise stay in memory for good.
+REVIEW_CACHE_SIZE = int(os.getenv("REVIEW_CACHE_SIZE", 64))
+# Reviews by key, along with the (mtime, size) of the game file they were
+# made from. A review is put in as soon as it starts, so that concurrent
+# requests for the same game wait on it instead of starting their own.
+reviews: OrderedDict[str, tuple[tuple[int, int], asyncio.Task[chess.pgn.Game]]] = (
+    OrderedDict()
+)
+
+
+async def _review(request: Request, gm: GameManager, key: str) -> chess.pgn.Game:
+    game = await gm.load(key)
+    reviewer = GameReviewer(request.app.state.engine_pool, engine)
+    return await reviewer.create_review(game, key)
+
+
+def _forget_failed(key: str, task: asyncio.Task[chess.pgn.Game]) -> None:
+    # Don't serve a failed review; the next request tries again.
+    if task.cancelled() or task.exception() is not None:
+        if key in reviews and reviews[key][1] is task:
+            del reviews[key]
+
+
 @app.get("/review/{key}")
 async def get_review(request: Request, key: str) -> Response:
     gm = GameManager()
-    game = gm.load(key)
-    reviewed_game = await GameReviewer().create_review(game)
+    # Games can be edited in place, so a review is only reused while the
+    # file is unchanged.
+    st = os.stat(gm.path(key))
+    stamp = (st.st_mtime_ns, st.st_size)
+    if key in reviews and reviews[key][0] == stamp:
+        reviews.move_to_end(key)
+        task = reviews[key][1]
+    else:
+        # Run the review as a task of its own, so that it carries on for
+        # the other requests waiting on it if this one is cancelled.
+        task = asyncio.create_task(_review(request, gm, key))
+        task.add_done_callback(functools.partial(_forget_failed, key))
+        reviews[key] = (stamp, task)
+        reviews.move_to_end(key)
+        if len(reviews) > REVIEW_CACHE_SIZE:
+            reviews.popitem(last=False)
+    reviewed_game = await asyncio.shield(task)
     return templates.TemplateResponse(
         "board.html", {"request": request, "pgn": gm.as_pgn(reviewed_game)}
     )
@@ -108,7 +178,7 @@ async def get_review(request: Request, key: str) -> Response:
 async def list_games(request: Request) -> Response:
     gm = GameManager()
     return templates.TemplateResponse(
-        "games.html", {"request": request, "games": gm.list()}
+        "games.html", {"request": request, "games": await gm.list()}
     )
 
 
@@ -123,11 +193,14 @@ async def submit_new_game_resp(
 ) -> Response:
     gm = GameManager()
     sio = StringIO(pgn)
-    game = chess.pgn.read_game(sio)
+    # As in GameManager.load, parse (and re-export) off the event loop
+    game = await asyncio.to_thread(chess.pgn.read_game, sio)
 
-    normalized_pgn = gm.as_pgn(game)
-    newkey = hashlib.sha256(normalized_pgn.encode("utf-8")).hexdigest()[:12] + ".pgn"
-    gm.save(newkey, game)
+    normalized_pgn = await asyncio.to_thread(gm.as_pgn, game)
+    # Keys are the first 6 bytes of the digest, as 12 hex digits
+    digest = hashlib.sha256(normalized_pgn.encode("utf-8")).digest()
+    newkey = digest[:6].hex() + ".pgn"
+    await gm.save(newkey, normalized_pgn)
 
     return RedirectResponse(
         app.url_path_for("get_review", key=newkey),
@@ -138,12 +211,19 @@ async def submit_new_game_resp(
 @app.get("/view/{key}")
 async def view(request: Request, key: str) -> Response:
     gm = GameManager()
-    game = gm.load(key)
+    game = await gm.load(key)
     return templates.TemplateResponse(
         "board.html", {"request": request, "pgn": gm.as_pgn(game)}
     )
 
 
+@app.get("/pgn/{key}")
+async def download(key: str) -> Response:
+    # Serve the stored file as it is, without parsing or re-exporting it
+    gm = GameManager()
+    return FileResponse(gm.path(key), media_type="application/x-chess-pgn")
+
+
 def main() -> None:
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
@@ -1,8 +1,37 @@
 import chess
 import chess.engine
+import chess.pgn
 
-ENGINE = "/Users/jmft2/.local/bin/stockfish.exe"
-default_fen = chess.STARTING_FEN
+
+def encode_position(board: chess.Board) -> bytes:
+    """
+    Encode a position as a compact, canonical key of at most 24 bytes,
+    following the Lichess binary FEN format: an occupancy bitboard, then
+    one nibble per occupied square. Move counters are not included, so
+    transpositions share a key.
+    """
+    ep_pawn = None
+    if board.has_legal_en_passant():
+        ep_pawn = board.ep_square + (-8 if board.turn == chess.WHITE else 8)
+    castling = board.clean_castling_rights()
+
+    nibbles = []
+    for square in chess.scan_forward(board.occupied):
+        piece = board.piece_at(square)
+        if square == ep_pawn:
+            nibbles.append(12)
+        elif castling & chess.BB_SQUARES[square]:
+            nibbles.append(13 if piece.color == chess.WHITE else 14)
+        elif piece.symbol() == "k" and board.turn == chess.BLACK:
+            # the side to move is folded into the black king
+            nibbles.append(15)
+        else:
+            nibbles.append(2 * (piece.piece_type - 1) + (piece.color == chess.BLACK))
+    if len(nibbles) % 2:
+        nibbles.append(0)
+
+    packed = bytes(lo | hi << 4 for lo, hi in zip(nibbles[::2], nibbles[1::2]))
+    return board.occupied.to_bytes(8, "big") + packed
 
 
 def sanitize_povscore(score: chess.engine.Score) -> str: